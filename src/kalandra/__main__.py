@@ -1,6 +1,10 @@
 import argparse
 import asyncio
+import functools
 import logging
+import os
+import sys
+from collections.abc import Callable
 
 from .commands.update_mirror import update_mirror
 from .transports import Transport
@@ -8,12 +12,39 @@ from .transports import Transport
 logger = logging.getLogger(__name__)
 
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+@functools.cache
 def create_parser():
     parser = argparse.ArgumentParser(description="Update a mirror of a git repository")
 
-    parser.add_argument("upstream", help="URL of the repository to take changes from")
-    parser.add_argument("mirror", help="URL of the mirror to push changes to")
+    parser.add_argument("upstream", nargs="?", help="URL of the repository to take changes from")
+    parser.add_argument("mirror", nargs="?", help="URL of the mirror to push changes to")
 
+    parser.add_argument(
+        "--pair",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("UPSTREAM", "MIRROR"),
+        help="URLs of another upstream and mirror to update, can be repeated",
+    )
+    parser.add_argument(
+        "--repos-file",
+        help="File with an 'UPSTREAM MIRROR' pair of URLs per line, to update multiple mirrors at once",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help="Maximum number of mirrors updated concurrently (default: number of CPUs)",
+    )
     parser.add_argument(
         "--dry-run",
         "-n",
@@ -24,18 +55,86 @@ def create_parser():
     return parser
 
 
+def read_repos_file(path: str) -> list[tuple[str, str]]:
+    """
+    Read (upstream, mirror) URL pairs from a file. Empty lines and lines starting with '#' are ignored.
+    """
+    pairs: list[tuple[str, str]] = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            urls = line.split()
+            if len(urls) != 2:
+                raise ValueError(f"{path}:{lineno}: expected 'UPSTREAM MIRROR', got: {line}")
+            pairs.append((urls[0], urls[1]))
+    return pairs
+
+
 async def main():
     parser = create_parser()
     args = parser.parse_args()
 
     logger.debug("Args: %s", args)
 
-    upstream = Transport.from_url(args.upstream)
-    mirror = Transport.from_url(args.mirror)
+    pairs: list[tuple[str, str]] = []
+    if args.upstream or args.mirror:
+        if not (args.upstream and args.mirror):
+            parser.error("both upstream and mirror are required")
+        pairs.append((args.upstream, args.mirror))
+    pairs.extend((upstream, mirror) for upstream, mirror in args.pair)
+    if args.repos_file:
+        try:
+            pairs.extend(read_repos_file(args.repos_file))
+        except (OSError, ValueError) as e:
+            parser.error(f"--repos-file: {e}")
+    if not pairs:
+        parser.error("either upstream and mirror, --pair or --repos-file is required")
+
+    semaphore = asyncio.Semaphore(args.jobs)
+    failed: list[tuple[str, str]] = []
+
+    async def mirror_one(upstream_url: str, mirror_url: str) -> None:
+        async with semaphore:
+            try:
+                upstream = Transport.from_url(upstream_url)
+                mirror = Transport.from_url(mirror_url)
+                await update_mirror(upstream, mirror, dry_run=args.dry_run)
+            except Exception:
+                if len(pairs) == 1:
+                    raise
+                # don't let one broken repository stop updating the other mirrors
+                logger.exception("Failed to update mirror %s from %s", mirror_url, upstream_url)
+                failed.append((upstream_url, mirror_url))
+
+    try:
+        if len(pairs) == 1:
+            # run it directly, so an error isn't wrapped in an ExceptionGroup by the TaskGroup
+            await mirror_one(*pairs[0])
+        else:
+            async with asyncio.TaskGroup() as tg:
+                for upstream_url, mirror_url in pairs:
+                    tg.create_task(mirror_one(upstream_url, mirror_url))
+    finally:
+        await Transport.close_pool()
+
+    if failed:
+        logger.error("Failed to update %d of %d mirrors", len(failed), len(pairs))
+        sys.exit(1)
+
 
-    await update_mirror(upstream, mirror, dry_run=args.dry_run)
+def event_loop_factory() -> Callable[[], asyncio.AbstractEventLoop] | None:
+    """
+    Use uvloop when it's installed (the "uvloop" extra), it's faster at pushing data through pipes and sockets.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return None
+    return uvloop.new_event_loop
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    asyncio.run(main())
+    logging.basicConfig(level=os.environ.get("KALANDRA_LOG_LEVEL", "INFO").upper())
+    asyncio.run(main(), loop_factory=event_loop_factory())
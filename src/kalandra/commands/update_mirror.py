@@ -1,38 +1,40 @@
+import asyncio
 import logging
 from typing import AsyncIterator
 
-import aiofiles
-
 from kalandra.gitprotocol import NULL_OBJECT_ID, Ref, RefChange
+from kalandra.streams import PipeStream
 from kalandra.transports import Transport
 
 logger = logging.getLogger(__name__)
 
 
-async def calculate_mirror_updates(mirror_refs: dict[str, str], upstream_refs: AsyncIterator[Ref]):
+async def calculate_mirror_updates(mirror_refs: dict[str, bytes], upstream_refs: AsyncIterator[Ref]):
     """
     Calculate the updates that need to be pushed to the mirror.
     """
-    refs_to_update = dict(mirror_refs)
+    # Mirror refs that are not in upstream will be deleted
+    upstream_names: set[str] = set()
 
     async for ref in upstream_refs:
         if not ref.name.startswith("refs"):
-            refs_to_update.pop(ref.name, None)
+            upstream_names.add(ref.name)
             continue
 
         if ref.name.startswith("refs/remotes/"):
             # if the upstream is a non-bare repository, we don't want to mirror remote branches
             continue
 
-        old_id = refs_to_update.pop(ref.name, NULL_OBJECT_ID)
+        upstream_names.add(ref.name)
+        old_id = mirror_refs.get(ref.name, NULL_OBJECT_ID)
         if old_id != ref.object_id:
             yield RefChange(ref.name, old_id, ref.object_id)
         else:
             logger.debug("Skipping %s, already up-to-date", ref.name)
 
     # Refs to delete
-    for ref, old_id in refs_to_update.items():
-        yield RefChange(ref, old_id, NULL_OBJECT_ID)
+    for name in mirror_refs.keys() - upstream_names:
+        yield RefChange(name, mirror_refs[name], NULL_OBJECT_ID)
 
 
 async def update_mirror(
@@ -58,16 +60,27 @@ async def update_mirror(
         if dry_run:
             return
 
-        # Fetch objects from upstream
-        async with aiofiles.tempfile.NamedTemporaryFile(suffix=".pack", encoding=None) as packfile:
-            new_objects = {change.new for change in changes}
-            new_objects.discard(NULL_OBJECT_ID)
-            have_objects = set(mirror_conn.refs.values())
-
-            logger.info("Fetching objects from upstream")
-            await upstream_conn.send_fetch_request(new_objects, have=have_objects, output=packfile)
-
-            # Push objects to mirror
-            await packfile.seek(0)
-            logger.info("Sending changes to mirror")
-            await mirror_conn.send_change_request(changes, packfile)
+        new_objects = {change.new for change in changes}
+        new_objects.discard(NULL_OBJECT_ID)
+        have_objects = set(mirror_conn.refs.values())
+
+        # The packfile is pushed to the mirror while it's still being fetched from upstream
+        packfile = PipeStream()
+
+        async def fetch_objects() -> None:
+            # the mirror only needs a packfile if there is anything besides deletes
+            if new_objects:
+                logger.info("Fetching objects from upstream")
+                await upstream_conn.send_fetch_request(new_objects, have=have_objects, output=packfile)
+            await packfile.close()
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(fetch_objects())
+                logger.info("Sending changes to mirror")
+                tg.create_task(mirror_conn.send_change_request(changes, packfile))
+        except ExceptionGroup as e:
+            # When one side fails the other one is cancelled, so there is usually just one error to report
+            if len(e.exceptions) == 1:
+                raise e.exceptions[0] from None
+            raise
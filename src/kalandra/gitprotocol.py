@@ -5,6 +5,10 @@ See: https://git-scm.com/docs/protocol-v2
 
 """
 
+import binascii
+import functools
+import os
+import sys
 from collections.abc import Buffer
 from enum import Enum
 from typing import NamedTuple
@@ -28,6 +32,12 @@ class PacketLineType(Enum):
             return cls(pkt_marker), 0
 
 
+# Markers of the control packets, they don't depend on the payload
+_CONTROL_MARKERS = {
+    pkt_type: b"%04x" % pkt_type.value for pkt_type in PacketLineType if pkt_type != PacketLineType.DATA
+}
+
+
 class PacketLine:
     """
     Represents a single packet line in the git protocol.
@@ -35,9 +45,8 @@ class PacketLine:
     See: https://git-scm.com/docs/gitprotocol-common#_pkt_line_format
     """
 
-    __slots__ = ("length", "data", "type")
+    __slots__ = ("data", "type")
 
-    length: int
     data: bytes
     type: PacketLineType
 
@@ -45,34 +54,42 @@ class PacketLine:
     DELIMITER: "PacketLine"
 
     @classmethod
-    def from_buffer(cls, data: Buffer) -> "PacketLine":
-        pkt_type, pkt_payload_length, pkt_payload = cls.sniff_buffer(data)
+    def from_buffer(cls, data: Buffer, offset: int = 0) -> "PacketLine":
+        pkt_type, pkt_payload_length, payload_offset = cls.sniff_buffer(data, offset)
         if pkt_type is None:
             raise ValueError("Not enough data to determine packet type")
         if pkt_payload_length < 0:
             raise ValueError("Not enough data to read the whole packet, need %d more bytes" % -pkt_payload_length)
+        if pkt_type != PacketLineType.DATA:
+            return cls.from_marker_and_payload(pkt_type, None)
 
-        return cls.from_marker_and_payload(pkt_type, pkt_payload)
+        return cls.from_marker_and_payload(
+            pkt_type, memoryview(data)[payload_offset : payload_offset + pkt_payload_length]
+        )
 
     @classmethod
     def from_marker_and_payload(cls, pkt_type: PacketLineType, payload: Buffer | None) -> "PacketLine":
         if pkt_type != PacketLineType.DATA:
-            return cls(0, b"", pkt_type)
+            return cls(b"", pkt_type)
         else:
             if payload is None:
                 raise ValueError("Payload is required for DATA packet type")
             mview = memoryview(payload)
-            return cls(len(mview), bytes(mview), pkt_type)
+            return cls(bytes(mview), pkt_type)
 
     @classmethod
     def data_from_string(cls, data: str) -> "PacketLine":
         encoded = f"{data}\n".encode("ascii")
-        return cls(len(encoded), encoded, PacketLineType.DATA)
+        return cls(encoded, PacketLineType.DATA)
 
     @classmethod
-    def sniff_buffer(cls, data: Buffer) -> "tuple[PacketLineType | None, int, Buffer | None]":
+    def data_from_bytes(cls, data: bytes) -> "PacketLine":
+        return cls(data + b"\n", PacketLineType.DATA)
+
+    @classmethod
+    def sniff_buffer(cls, data: Buffer, offset: int = 0) -> "tuple[PacketLineType | None, int, int]":
         """
-        Sniff the buffer to determine the type of packet line and its length.
+        Sniff the buffer at the given offset to determine the type of packet line and its length.
 
         If there is not enough data to determine the type, returns None and a negative number
         indicating the number of bytes missing to determine the type.
@@ -82,30 +99,40 @@ class PacketLine:
 
         If there is enough data to determine the type and read the whole packet,
         returns the type and the length of the packet's payload.
+
+        The last element is the offset of the payload in the buffer, so a parser can walk over
+        a buffer with multiple packets without slicing it.
         """
-        mview = memoryview(data)
-        mview_length = len(mview)
-        if mview_length < 4:
+        buffer = data if isinstance(data, (bytes, bytearray)) else memoryview(data).cast("B")
+        available = len(buffer) - offset
+        payload_offset = offset + 4
+        if available < 4:
             # Not enough data to read the length
-            return None, 4 - mview_length, None
+            return None, available - 4, payload_offset
 
-        pkt_marker = int(bytes(mview[:4]), 16)
+        marker = buffer[offset:payload_offset]
+        pkt_marker = int(marker if not isinstance(marker, memoryview) else marker.tobytes(), 16)
         if pkt_marker >= 4:
-            if pkt_marker > len(mview):
+            if pkt_marker > available:
                 # we know the length, but we don't have enough data to read the whole packet
-                return PacketLineType.DATA, len(mview) - pkt_marker, None
-            return PacketLineType.DATA, pkt_marker - 4, mview[4:pkt_marker]
+                return PacketLineType.DATA, available - pkt_marker, payload_offset
+            return PacketLineType.DATA, pkt_marker - 4, payload_offset
         else:
-            return PacketLineType(pkt_marker), 0, None
+            return PacketLineType(pkt_marker), 0, payload_offset
 
-    def __init__(self, length: int, data: bytes, type: PacketLineType):
-        self.length = length
+    def __init__(self, data: bytes, type: PacketLineType):
         self.data = data
         self.type = type
 
+    @property
+    def length(self) -> int:
+        return len(self.data)
+
     @property
     def marker_bytes(self) -> bytes:
-        return b"%04x" % (self.length + 4 if self.type == PacketLineType.DATA else self.type.value)
+        if self.type == PacketLineType.DATA:
+            return b"%04x" % (len(self.data) + 4)
+        return _CONTROL_MARKERS[self.type]
 
     def __repr__(self) -> str:
         if self.length < 100:
@@ -118,33 +145,56 @@ PacketLine.FLUSH = PacketLine.from_marker_and_payload(PacketLineType.FLUSH, None
 PacketLine.DELIMITER = PacketLine.from_marker_and_payload(PacketLineType.DELIMITER, None)
 
 
-NULL_OBJECT_ID = "0" * 40
+# Object IDs are kept as raw bytes (20 for SHA-1), they are only hex encoded on the wire
+NULL_OBJECT_ID = bytes(20)
+# Number of parsed ref lines to keep, the same refs are advertised again when an upstream is mirrored
+# to several mirrors or the same repositories are mirrored in a loop. Caching is disabled by default.
+REF_CACHE_SIZE = int(os.environ.get("KALANDRA_REF_CACHE_SIZE", "0"))
 
 
 class Ref(NamedTuple):
     name: str
-    object_id: str
+    object_id: bytes
 
     @classmethod
     def from_line(cls, line: str) -> "Ref":
-        parts = line.split(" ")
-        if len(parts) != 2:
+        object_id, sep, name = line.partition(" ")
+        if not sep or not name or " " in name:
             raise ValueError(f"Invalid ref line: {line}")
-        return cls(name=parts[1], object_id=parts[0])
+        # ls-refs responses can have many thousands of refs, skip the argument handling of the NamedTuple constructor.
+        # The same names are read from both upstream and mirror, interning lets their dicts and sets share the strings.
+        return tuple.__new__(cls, (sys.intern(name), bytes.fromhex(object_id)))
+
+    @classmethod
+    def from_line_bytes(cls, data: bytes) -> "Ref":
+        """
+        Parse the payload of a ref pkt-line, without decoding the whole line first.
+        """
+        object_id, sep, name = data.rstrip().partition(b" ")
+        if not sep or not name or b" " in name:
+            raise ValueError(f"Invalid ref line: {data!r}")
+        return tuple.__new__(cls, (sys.intern(name.decode("ascii")), binascii.a2b_hex(object_id)))
+
+
+if REF_CACHE_SIZE > 0:
+    # Refs are immutable, so the parsed ones can be shared between connections
+    Ref.from_line_bytes = classmethod(  # type: ignore[method-assign]
+        functools.lru_cache(maxsize=REF_CACHE_SIZE)(Ref.from_line_bytes.__func__)
+    )
 
 
 class RefChange(NamedTuple):
     ref: str
-    old: str
-    new: str
+    old: bytes
+    new: bytes
 
     def __str__(self) -> str:
         if self.is_create:
-            return f"CREATE {self.ref} {self.new}"
+            return f"CREATE {self.ref} {self.new.hex()}"
         elif self.is_delete:
-            return f"DELETE {self.ref} {self.old}"
+            return f"DELETE {self.ref} {self.old.hex()}"
         else:
-            return f"UPDATE {self.ref} {self.old}..{self.new}"
+            return f"UPDATE {self.ref} {self.old.hex()}..{self.new.hex()}"
 
     @property
     def is_delete(self) -> bool:
@@ -0,0 +1,59 @@
+"""
+Byte streams used to pass packfiles between connections.
+"""
+
+import asyncio
+from collections.abc import Buffer
+from typing import Protocol
+
+
+class AsyncReader(Protocol):
+    async def read(self, size: int = -1, /) -> bytes: ...
+
+
+class AsyncWriter(Protocol):
+    async def write(self, data: Buffer, /) -> int: ...
+
+
+class PipeStream:
+    """
+    In-memory pipe between a writer and a reader running concurrently.
+
+    Data is passed on in the chunks it was written in. Writes wait while ``max_chunks``
+    chunks are not yet read, so a fast writer can't buffer the whole stream in memory.
+    """
+
+    def __init__(self, max_chunks: int = 16):
+        self._chunks: asyncio.Queue[bytes] = asyncio.Queue(max_chunks)
+        self._pending = b""
+        self._eof = False
+
+    async def write(self, data: Buffer, /) -> int:
+        chunk = bytes(data)
+        if chunk:
+            await self._chunks.put(chunk)
+        return len(chunk)
+
+    async def close(self) -> None:
+        """
+        Signal the reader that no more data will be written.
+        """
+        await self._chunks.put(b"")
+
+    async def read(self, size: int = -1, /) -> bytes:
+        """
+        Read up to ``size`` bytes (the rest of the current chunk if negative). Returns b"" at the end of stream.
+        """
+        if not self._pending:
+            if self._eof:
+                return b""
+            self._pending = await self._chunks.get()
+            if not self._pending:
+                self._eof = True
+                return b""
+
+        if size < 0 or size >= len(self._pending):
+            data, self._pending = self._pending, b""
+        else:
+            data, self._pending = self._pending[:size], self._pending[size:]
+        return data
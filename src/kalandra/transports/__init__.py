@@ -1,8 +1,10 @@
-from .base import BaseConnection, FetchConnection, Transport
+from typing import TYPE_CHECKING
 
-# Import all the transports so they can be used
+from .base import BaseConnection, FetchConnection, Transport
 from .file import FileTransport
-from .ssh import SSHTransport
+
+if TYPE_CHECKING:
+    from .ssh import SSHTransport
 
 __all__ = [
     "BaseConnection",
@@ -11,3 +13,12 @@ __all__ = [
     "SSHTransport",
     "Transport",
 ]
+
+
+def __getattr__(name: str):
+    # asyncssh takes long to import, so only load the SSH transport when it's actually used
+    if name == "SSHTransport":
+        from .ssh import SSHTransport
+
+        return SSHTransport
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
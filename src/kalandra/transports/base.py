@@ -1,21 +1,57 @@
+import binascii
+import functools
+import importlib
 import itertools
 import logging
 from abc import ABCMeta, abstractmethod
 from asyncio import IncompleteReadError, StreamReader, StreamWriter
 from typing import AsyncIterator, Iterable
 
-from aiofiles.threadpool.binary import AsyncBufferedIOBase
-
-from kalandra.gitprotocol import PacketLine, PacketLineType, Ref, RefChange
+from kalandra.gitprotocol import NULL_OBJECT_ID, PacketLine, PacketLineType, Ref, RefChange
+from kalandra.streams import AsyncReader, AsyncWriter
 
 logger = logging.getLogger(__name__)
 
+# Maximum size of the chunks in which packfiles are sent to the server
+PACKFILE_CHUNK_SIZE = 1024 * 1024
+# Side-band packets carry at most 64 KiB of the packfile, they are passed on to the output in larger batches.
+# Batches never exceed PACKFILE_CHUNK_SIZE, so the push side reads each of them whole instead of splitting it.
+OUTPUT_BATCH_SIZE = PACKFILE_CHUNK_SIZE
+# Maximum size of a single read from the server, one read usually holds many pkt-lines
+READ_CHUNK_SIZE = 64 * 1024
+# Log levels of the side-band streams other than the packfile data: 2 is progress, 3 is a fatal error
+SIDEBAND_LOG_LEVELS = {2: logging.INFO, 3: logging.ERROR}
+
 
 class ConnectionException(Exception):
     pass
 
 
+# Modules implementing transports for the given URL prefix. They are only imported
+# once a matching URL is used, so heavy dependencies (e.g. asyncssh) are not loaded upfront.
+TRANSPORT_MODULES = {
+    "file://": "kalandra.transports.file",
+    "ssh://": "kalandra.transports.ssh",
+}
+
+# Transport classes registered for the URL prefix they handle, see Transport.__init_subclass__
+_TRANSPORTS: dict[str, type["Transport"]] = {}
+
+
+@functools.lru_cache(maxsize=256)
+def _command_packet(data: str) -> PacketLine:
+    # Command and capability lines are the same for every request, packets are never modified once built
+    return PacketLine.data_from_string(data)
+
+
 class Transport(metaclass=ABCMeta):
+    __slots__ = ("url",)
+
+    def __init_subclass__(cls, url_prefix: str | None = None, **kwargs) -> None:  # type: ignore
+        super().__init_subclass__(**kwargs)
+        if url_prefix is not None:
+            _TRANSPORTS[url_prefix] = cls
+
     def __init__(self, url: str):
         self.url = url
 
@@ -46,11 +82,29 @@ class Transport(metaclass=ABCMeta):
         """
         Create a transport instance from a URL.
         """
-        for cls in cls.__subclasses__():
-            if cls.can_handle_url(url):
-                return cls(url)
+        scheme, sep, _ = url.partition("://")
+        prefix = scheme + sep
+        if prefix not in _TRANSPORTS and prefix in TRANSPORT_MODULES:
+            importlib.import_module(TRANSPORT_MODULES[prefix])
+
+        transport_cls = _TRANSPORTS.get(prefix)
+        if transport_cls is not None:
+            return transport_cls(url)
+
+        # Transports that can't be told apart by the URL prefix alone
+        for subclass in cls.__subclasses__():
+            if subclass.can_handle_url(url):
+                return subclass(url)
         raise ValueError(f"Unsupported URL: {url}")
 
+    @classmethod
+    async def close_pool(cls) -> None:
+        """
+        Close connections kept open for reuse by this transport and all of its subclasses.
+        """
+        for subclass in cls.__subclasses__():
+            await subclass.close_pool()
+
 
 class BaseConnection[T: Transport]:
     capabilities: frozenset[str]
@@ -67,6 +121,8 @@ class BaseConnection[T: Transport]:
 
         self.git_protocol = ""
         self.last_packet: PacketLine | None = None
+        # Data read from the server, but not yet parsed into packets
+        self._read_buffer = bytearray()
 
     @abstractmethod
     async def _close_service_connection(self) -> None:
@@ -76,22 +132,45 @@ class BaseConnection[T: Transport]:
         pass
 
     async def _read_packet(self) -> PacketLine:
-        assert self.reader is not None
+        """
+        Read the next packet. Only waits for the server if the packet isn't already buffered.
 
-        pkt_marker = await self.reader.readexactly(4)
-        pkt_type, payload_length = PacketLineType.from_bytes(pkt_marker)
+        Raises IncompleteReadError if the server closes the connection in the middle of a packet.
+        """
+        assert self.reader is not None
 
-        if pkt_type == PacketLineType.DATA:
-            pkt_payload = await self.reader.readexactly(payload_length)
-            return PacketLine.from_marker_and_payload(pkt_type, pkt_payload)
-        else:
+        buffer = self._read_buffer
+        while True:
+            pkt_type, payload_length, payload_offset = PacketLine.sniff_buffer(buffer)
+            if pkt_type is not None and payload_length >= 0:
+                break
+            chunk = await self.reader.read(READ_CHUNK_SIZE)
+            if not chunk:
+                # payload_length is the negated number of missing bytes
+                raise IncompleteReadError(bytes(buffer), len(buffer) - payload_length)
+            buffer += chunk
+
+        if pkt_type != PacketLineType.DATA:
+            del buffer[:payload_offset]
             return PacketLine.from_marker_and_payload(pkt_type, None)
 
+        end = payload_offset + payload_length
+        with memoryview(buffer) as view:
+            payload = view[payload_offset:end].tobytes()
+        # deleting from the front of a bytearray doesn't move the remaining data
+        del buffer[:end]
+        return PacketLine(payload, pkt_type)
+
     async def _read_packets_until_flush(self) -> AsyncIterator[PacketLine]:
+        """
+        Read DATA packets until a flush packet is received.
+        """
         while True:
             try:
                 packet = await self._read_packet()
-                if packet.type == PacketLineType.FLUSH:
+                if packet.type != PacketLineType.DATA:
+                    if packet.type != PacketLineType.FLUSH:
+                        raise ValueError(f"Unexpected packet type before FLUSH: {packet.type}")
                     self.last_packet = packet
                     return
                 yield packet
@@ -102,14 +181,16 @@ class BaseConnection[T: Transport]:
 
     async def _read_packets_section(self) -> AsyncIterator[PacketLine]:
         """
-        Read packets until a either delimiter or flush packet is received.
+        Read DATA packets until a either delimiter or flush packet is received.
 
         The caller can check which packet was received by looking at the last_packet attribute after the iteration is done.
         """
         while True:
             try:
                 packet = await self._read_packet()
-                if packet.type in (PacketLineType.FLUSH, PacketLineType.DELIMITER):
+                if packet.type != PacketLineType.DATA:
+                    if packet.type not in (PacketLineType.FLUSH, PacketLineType.DELIMITER):
+                        raise ValueError(f"Unexpected packet type in section: {packet.type}")
                     self.last_packet = packet
                     return
                 yield packet
@@ -118,23 +199,62 @@ class BaseConnection[T: Transport]:
                     raise ValueError(f"Unexpected EOF while reading packet length: {e.partial}")
                 raise ValueError("Reached EOF before FLUSH packet") from e
 
-    async def _write_packet(self, packet: PacketLine) -> None:
+    def _queue_packet(self, packet: PacketLine) -> None:
+        """
+        Queue a packet in the writer's buffer, it's sent on the next _flush().
+        """
+        assert self.writer is not None
+
+        self.writer.write(packet.marker_bytes + packet.data)
+
+    def _queue_packets(self, packets: Iterable[PacketLine]) -> None:
+        """
+        Queue multiple packets in the writer's buffer, they are sent on the next _flush().
+        """
+        assert self.writer is not None
+
+        self.writer.writelines(itertools.chain.from_iterable((packet.marker_bytes, packet.data) for packet in packets))
+
+    async def _flush(self) -> None:
+        """
+        Wait until the queued packets are passed on to the server.
+        """
         assert self.writer is not None
 
-        self.writer.write(packet.marker_bytes)
-        self.writer.write(packet.data)
         await self.writer.drain()
 
-    async def _read_header_packet(self, section: AsyncIterator[PacketLine]) -> str:
+    async def _close(self, last_packet: PacketLine | None) -> None:
+        """
+        Send the last packet (if any) and EOF to the server, then close the connection.
+        """
+        if self.writer:
+            logger.debug("Closing writer")
+            if last_packet is not None and not self.writer.is_closing():
+                self._queue_packet(last_packet)
+                self.writer.write_eof()
+                try:
+                    await self._flush()
+                except ConnectionError:
+                    # the server is done with us either way
+                    logger.debug("Server closed the connection before the last packet", exc_info=True)
+            self.writer.close()
+            self.writer = None
+
+        if self.reader:
+            logger.debug("Closing reader")
+            self.reader.feed_eof()
+            self.reader = None
+
+        await self._close_service_connection()
+
+    async def _read_header_packet(self, section: AsyncIterator[PacketLine]) -> bytes:
         header = await anext(section)
-        if header.type != PacketLineType.DATA:
-            raise ValueError(f"Unexpected packet type: {header.type}: {header.data}")
-        return header.data.decode("ascii").rstrip()
+        return header.data.rstrip()
 
     async def _send_command_v2(
         self,
         command: str,
-        args: Iterable[str],
+        args: Iterable[bytes],
         **capabilities: dict[str, str],
     ) -> None:
         """
@@ -142,22 +262,25 @@ class BaseConnection[T: Transport]:
 
         See: https://git-scm.com/docs/gitprotocol-v2#_command_request
         """
-        # Send command
-        await self._write_packet(PacketLine.data_from_string(f"command={command}"))
-        # Send capabilities
+        # Command
+        packets = [_command_packet(f"command={command}")]
+        # Capabilities
         for key, value in capabilities.items():
             data = f"{key}={value}" if len(value) > 0 else key
-            await self._write_packet(PacketLine.data_from_string(data))
+            packets.append(_command_packet(data))
+
+        packets.append(PacketLine.DELIMITER)
 
-        await self._write_packet(PacketLine.DELIMITER)
+        # Arguments
+        packets.extend(PacketLine.data_from_bytes(arg) for arg in args)
 
-        # send arguments
-        for arg in args:
-            await self._write_packet(PacketLine.data_from_string(arg))
+        packets.append(PacketLine.FLUSH)
 
-        await self._write_packet(PacketLine.FLUSH)
+        # The server can't respond before it gets the whole request, so send it in one go
+        self._queue_packets(packets)
+        await self._flush()
 
-    async def _read_v1_server_hello(self) -> tuple[dict[str, str], frozenset[str]]:
+    async def _read_v1_server_hello(self) -> tuple[dict[str, bytes], frozenset[str]]:
         """
         Process the first ref packet received from the server.
 
@@ -166,22 +289,25 @@ class BaseConnection[T: Transport]:
         # Read the capabilities from the server (https://git-scm.com/docs/protocol-v2#_capability_advertisement)
         section = self._read_packets_section()
         version_data = await self._read_header_packet(section)
-        if version_data != "version 1":
-            raise ValueError(f"Expected 'version 1' packet, instead got: {version_data}")
+        if version_data != b"version 1":
+            raise ValueError(f"Expected 'version 1' packet, instead got: {version_data!r}")
 
-        refs: dict[str, str] = {}
+        refs: dict[str, bytes] = {}
 
         first_ref_extended = await self._read_header_packet(section)
-        first_ref_data, capabilities_list = first_ref_extended.split("\x00", 1)
-        first_ref = Ref.from_line(first_ref_data)
-        refs[first_ref.name] = first_ref.object_id
+        first_ref_data, sep, capabilities_list = first_ref_extended.partition(b"\0")
+        if not sep:
+            raise ValueError(f"Expected capabilities after the first ref, instead got: {first_ref_extended!r}")
+        first_ref = Ref.from_line_bytes(first_ref_data)
+        # A repository without any refs sends its capabilities on a placeholder ref, it's not a real ref to update
+        if first_ref.name != "capabilities^{}":
+            refs[first_ref.name] = first_ref.object_id
 
         async for packet in section:
-            assert packet.type == PacketLineType.DATA
-            ref = Ref.from_line(packet.data.decode("ascii").rstrip())
+            ref = Ref.from_line_bytes(packet.data)
             refs[ref.name] = ref.object_id
 
-        return refs, frozenset(capabilities_list.split(" "))
+        return refs, frozenset(capabilities_list.decode("ascii").split(" "))
 
 
 class FetchConnection[T: Transport](BaseConnection[T]):
@@ -210,78 +336,65 @@ class FetchConnection[T: Transport](BaseConnection[T]):
 
         advertised_capabilities: set[str] = set()
         async for packet in self._read_packets_until_flush():
-            assert packet.type == PacketLineType.DATA
             advertised_capabilities.add(packet.data.decode("ascii").rstrip())
 
         self.capabilities = frozenset(advertised_capabilities)
-        logger.debug(f"Connected with capabilities: {self.capabilities}")
+        logger.debug("Connected with capabilities: %s", self.capabilities)
 
         # We expect the server to send us the capabilities and end with a flush packet
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:  # type: ignore
-        if self.writer:
-            logger.debug("Closing writer")
-            await self._write_packet(PacketLine.FLUSH)
-            self.writer.write_eof()
-            await self.writer.drain()
-            self.writer.close()
-            self.writer = None
-
-        if self.reader:
-            logger.debug("Closing reader")
-            self.reader.feed_eof()
-            self.reader = None
-
-        await self._close_service_connection()
+        # A flush packet instead of a command tells the server to exit
+        await self._close(PacketLine.FLUSH)
 
     async def ls_refs(self, prefix: str = "") -> AsyncIterator[Ref]:
-        args: list[str] = []
+        args: list[bytes] = []
         if prefix:
-            args.append(f"ref-prefix {prefix}")
+            args.append(b"ref-prefix " + prefix.encode("ascii"))
         # Send the command
         await self._send_command_v2("ls-refs", args)
 
         # Read the response
         async for packet in self._read_packets_until_flush():
-            assert packet.type == PacketLineType.DATA
-            ref = Ref.from_line(packet.data.decode("ascii").rstrip())
+            ref = Ref.from_line_bytes(packet.data)
             if prefix and not ref.name.startswith(prefix):
                 continue
             yield ref
 
-    async def _process_ack_section(self, ack_section: AsyncIterator[PacketLine], missing_objects: set[str]):
+    async def _process_ack_section(self, ack_section: AsyncIterator[PacketLine], missing_objects: set[bytes]):
+        # The section is "NAK" or a number of "ACK <oid>" lines, optionally followed by "ready".
+        # Read it up to the delimiter, so the next section starts with its header.
         async for ack in ack_section:
-            if ack.data == b"nak\n":
-                break
-            if ack.data.startswith(b"ack\0"):
-                obj_id = ack.data[4:].decode("ascii").strip()
-                try:
-                    missing_objects.remove(obj_id)
-                except KeyError:
-                    logger.warning(f"Received ACK for unknown object: {obj_id}")
-            if ack.data == b"ready\n":
-                break
+            data = ack.data
+            if data.startswith(b"ACK "):
+                missing_objects.discard(binascii.a2b_hex(data[4:].rstrip()))
+            elif data not in (b"NAK\n", b"ready\n"):
+                logger.warning("Unexpected line in acknowledgments: %r", data)
 
         assert self.last_packet, "Expected last packet to be set"
         if self.last_packet.type == PacketLineType.FLUSH:
-            raise ConnectionException("Server negotiation failed. Missing objects: %s" % (missing_objects,))
+            raise ConnectionException(
+                "Server negotiation failed. Missing objects: %s" % ", ".join(obj.hex() for obj in missing_objects)
+            )
 
     async def send_fetch_request(
         self,
-        objects: set[str],
+        objects: set[bytes],
         *,
-        have: set[str] | None = None,
-        output: AsyncBufferedIOBase,
+        have: set[bytes] | None = None,
+        output: AsyncWriter,
     ) -> None:
         # Send the command
-        base_args = ()
+        args: list[bytes] = []
         if "wait-for-done" in self.capabilities:
-            base_args += ("wait-for-done",)
-
-        have_args = ("have " + obj for obj in have) if have else ()
-        want_args = ("want " + obj for obj in objects)
-        await self._send_command_v2("fetch", args=itertools.chain(base_args, have_args, want_args, ("done",)))
+            args.append(b"wait-for-done")
+        # Sorted, so the same fetch always sends the same request
+        if have:
+            args += [b"have " + binascii.hexlify(obj) for obj in sorted(have)]
+        args += [b"want " + binascii.hexlify(obj) for obj in sorted(objects)]
+        args.append(b"done")
+        await self._send_command_v2("fetch", args=args)
 
         # NOTE: we always send the "done" immediately not waiting for the server to send us the acks
         #       as we can't really do anything with missing objects anyway
@@ -295,16 +408,16 @@ class FetchConnection[T: Transport](BaseConnection[T]):
         #     packfile flush-pkt
 
         ## 1. acknowledgements flush-pkt | [acknowledgments delim-pkt]
-        missing_objects: set[str] = set(objects)
+        missing_objects: set[bytes] = set(objects)
 
         section = self._read_packets_section()
         header_name = await self._read_header_packet(section)
 
-        if header_name == "acknowledgments":
+        if header_name == b"acknowledgments":
             await self._process_ack_section(section, missing_objects)
             # after done, missing_objects contains all non-acked objects
 
-            logger.info(f"Did not receive ACKs for {len(missing_objects)} objects")
+            logger.info("Did not receive ACKs for %d objects", len(missing_objects))
 
             # read the next section
             section = self._read_packets_section()
@@ -315,24 +428,32 @@ class FetchConnection[T: Transport](BaseConnection[T]):
         ## 4. We don't request packfile-uris, so we skip it
 
         # 5. packfile flush-pkt
-        if header_name != "packfile":
-            raise ConnectionException(f"Unexpected section: {header_name}")
+        if header_name != b"packfile":
+            raise ConnectionException(f"Unexpected section: {header_name!r}")
 
+        # This loop runs for every packet of the packfile, so keep lookups out of it
+        pending: list[memoryview] = []
+        add_pending = pending.append
+        pending_size = 0
         async for packet in section:
-            assert packet.type == PacketLineType.DATA
-            stream_code = packet.data[0]
+            data = packet.data
+            stream_code = data[0]
             if stream_code == 1:
-                await output.write(memoryview(packet.data)[1:])
-            elif stream_code == 2:
-                msg = packet.data[1:].decode("utf-8")
-                logger.info(msg)
-            elif stream_code == 3:
-                msg = packet.data[1:].decode("utf-8")
-                logger.error(msg)
+                size = len(data) - 1
+                if pending_size + size > OUTPUT_BATCH_SIZE:
+                    await output.write(b"".join(pending))
+                    pending.clear()
+                    pending_size = 0
+                add_pending(memoryview(data)[1:])
+                pending_size += size
+            elif stream_code in SIDEBAND_LOG_LEVELS:
+                logger.log(SIDEBAND_LOG_LEVELS[stream_code], "%s", data[1:].decode("utf-8"))
+        if pending:
+            await output.write(b"".join(pending))
 
         assert self.last_packet, "Expected last packet to be set"
         if self.last_packet.type != PacketLineType.FLUSH:  # type: ignore
-            logger.warning(f"Unexpected packet type at end of packfile: {self.last_packet.type}")
+            logger.warning("Unexpected packet type at end of packfile: %s", self.last_packet.type)
 
 
 class PushConnection[T: Transport](BaseConnection[T]):
@@ -345,7 +466,9 @@ class PushConnection[T: Transport](BaseConnection[T]):
 
         # git-receive-pack does not support protocol v2 yet, so make sure we use v1
         self.git_protocol = "version=1"
-        self.refs = {}
+        self.refs: dict[str, bytes] = {}
+        # Whether the update commands were sent, the server exits after handling them
+        self.request_sent = False
 
     @abstractmethod
     async def _open_push_service_connection(self) -> tuple[StreamReader, StreamWriter]:
@@ -363,26 +486,15 @@ class PushConnection[T: Transport](BaseConnection[T]):
         # Read the first ref packet, which is special as it will contain the capabilities
         self.refs, self.capabilities = await self._read_v1_server_hello()
 
-        logger.debug(f"Connected with capabilities: {self.capabilities}")
+        logger.debug("Connected with capabilities: %s", self.capabilities)
 
         # We expect the server to send us the capabilities and end with a flush packet
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:  # type: ignore
-        if self.writer:
-            logger.debug("Closing writer")
-            await self._write_packet(PacketLine.FLUSH)
-            self.writer.write_eof()
-            await self.writer.drain()
-            self.writer.close()
-            self.writer = None
-
-        if self.reader:
-            logger.debug("Closing reader")
-            self.reader.feed_eof()
-            self.reader = None
-
-        await self._close_service_connection()
+        # Once it has handled the commands the server exits on its own, it may have already closed the pipe.
+        # Otherwise, an empty list of commands tells the server there is nothing to update.
+        await self._close(None if self.request_sent else PacketLine.FLUSH)
 
     def add_capability_if_supported(self, in_use: set[str], capability: str) -> bool:
         if capability in self.capabilities:
@@ -390,7 +502,7 @@ class PushConnection[T: Transport](BaseConnection[T]):
             return True
         return False
 
-    async def send_change_request(self, changes: list[RefChange], packfile: AsyncBufferedIOBase) -> None:
+    async def send_change_request(self, changes: list[RefChange], packfile: AsyncReader) -> None:
         """
         Send a change request to the server.
 
@@ -407,38 +519,51 @@ class PushConnection[T: Transport](BaseConnection[T]):
         supports_delete = "delete-refs" in self.capabilities
 
         has_non_deletes = False
+        packets: list[PacketLine] = []
 
-        for change in changes:
-            if change.is_delete:
+        # RefChange is a tuple, unpacking it is cheaper than looking up its fields for every change
+        for ref, old, new in changes:
+            if new == NULL_OBJECT_ID:
                 if not supports_delete:
-                    logger.warning(f"Server does not support delete-refs capability, skipping delete of {change.ref}")
+                    logger.warning("Server does not support delete-refs capability, skipping delete of %s", ref)
                     continue
             else:
                 has_non_deletes = True
 
-            line = f"{change.old} {change.new} {change.ref}"
+            line = b"%s %s %s" % (binascii.hexlify(old), binascii.hexlify(new), ref.encode("ascii"))
             if first:
-                line += "\0" + " ".join(use_capabilties)
+                line += b"\0" + " ".join(use_capabilties).encode("ascii")
                 first = False
-            await self._write_packet(PacketLine.data_from_string(line))
-
-        # The command is terminated with a flush packet
-        await self._write_packet(PacketLine.FLUSH)
+            packets.append(PacketLine.data_from_bytes(line))
 
-        if not has_non_deletes:
-            logger.info("No non-delete changes to send, skipping packfile")
+        if not packets:
+            # Nothing left to update, __aexit__ sends the empty list of commands
+            logger.info("No changes the server can apply")
             return
 
-        # Send the packfile
-        logger.info("Sending packfile")
-        await packfile.seek(0)
-        async for chunk in packfile:
-            self.writer.write(chunk)
-            await self.writer.drain()
+        # The command is terminated with a flush packet
+        packets.append(PacketLine.FLUSH)
+        self._queue_packets(packets)
+        await self._flush()
+        self.request_sent = True
+
+        if has_non_deletes:
+            logger.info("Sending packfile")
+            await self._send_packfile(packfile)
+        else:
+            # The server must not get a packfile when all commands are deletes
+            logger.info("No non-delete changes to send, skipping packfile")
 
-        # Try to read the report-status
+        # The server applies the commands before it reports their status, it can't be closed until then
         if "report-status" in use_capabilties:
             logger.info("Reading report-status")
             async for packet in self._read_packets_until_flush():
-                assert packet.type == PacketLineType.DATA
-                logger.info(packet.data.decode("utf-8").strip())
+                logger.info("%s", packet.data.decode("utf-8").strip())
+
+    async def _send_packfile(self, packfile: AsyncReader) -> None:
+        assert self.writer is not None
+
+        # Iterating over the file would split the binary packfile at newlines, producing chunks of random size
+        while chunk := await packfile.read(PACKFILE_CHUNK_SIZE):
+            self.writer.write(chunk)
+            await self.writer.drain()
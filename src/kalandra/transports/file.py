@@ -1,5 +1,9 @@
 import asyncio
+import functools
 import logging
+import os
+import shutil
+import weakref
 from pathlib import Path
 from typing import Literal
 
@@ -7,6 +11,46 @@ from .base import BaseConnection, FetchConnection, PushConnection, Transport
 
 logger = logging.getLogger(__name__)
 
+# How long to wait for the git service to exit before killing it (in seconds)
+PROCESS_EXIT_TIMEOUT = 10
+# Size of the stdout buffer before the pipe is paused, packfiles are streamed through it
+STREAM_BUFFER_LIMIT = 1 << 20
+# Variables passed on from our environment to the git services, besides GIT_PROTOCOL
+SERVICE_ENV_VARS = ("PATH", "HOME")
+
+# Spawn semaphores of the event loops that started git services, see _spawn_semaphore()
+_spawn_semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = weakref.WeakKeyDictionary()
+
+
+def _spawn_semaphore() -> asyncio.Semaphore:
+    """
+    Limits how many git services are being spawned at the same time. It only covers the spawn calls, the services
+    themselves run for as long as their connections are open. Holding a slot for the connection's lifetime would
+    deadlock with a single slot, as every mirror update keeps a fetch and a push connection open at once.
+
+    asyncio primitives are bound to the event loop that first waits on them, so each loop gets its own semaphore.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _spawn_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _spawn_semaphores[loop] = asyncio.Semaphore(os.cpu_count() or 1)
+    return semaphore
+
+
+@functools.cache
+def _find_executable(name: str) -> str:
+    # subprocess can only use the faster posix_spawn() when given a path to the executable
+    path = shutil.which(name)
+    if path is None:
+        raise FileNotFoundError(f"Executable {name} not found in PATH")
+    return path
+
+
+def _service_env(git_protocol: str) -> dict[str, str]:
+    env = {name: os.environ[name] for name in SERVICE_ENV_VARS if name in os.environ}
+    env["GIT_PROTOCOL"] = git_protocol
+    return env
+
 
 class FileConnection(BaseConnection["FileTransport"]):
     process: asyncio.subprocess.Process
@@ -15,17 +59,22 @@ class FileConnection(BaseConnection["FileTransport"]):
         self, service_name: Literal["git-upload-pack", "git-receive-pack"]
     ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
         logger.debug("Connecting to %s", self.transport.path)
-        self.process = await asyncio.create_subprocess_exec(
-            service_name,
-            self.transport.path,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=None,
-            env={"GIT_PROTOCOL": self.git_protocol},
-        )
+        async with _spawn_semaphore():
+            self.process = await asyncio.create_subprocess_exec(
+                _find_executable(service_name),
+                self.transport.path,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=None,
+                limit=STREAM_BUFFER_LIMIT,
+                env=_service_env(self.git_protocol),
+                # All our descriptors are non-inheritable (PEP 446), so there is nothing to close.
+                # This lets subprocess use posix_spawn() instead of fork() + exec().
+                close_fds=False,
+            )
 
         if self.process.returncode is not None:
-            logger.error(f"Failed to start process {service_name}: {self.process} / {self.process.returncode}")
+            logger.error("Failed to start process %s: %s / %s", service_name, self.process, self.process.returncode)
             raise RuntimeError(f"Failed to start process {service_name}")
 
         assert self.process.stdout is not None
@@ -36,7 +85,12 @@ class FileConnection(BaseConnection["FileTransport"]):
     async def _close_service_connection(self) -> None:
         if self.process.returncode is None:
             self.process.terminate()
-        await self.process.wait()
+        try:
+            await asyncio.wait_for(self.process.wait(), PROCESS_EXIT_TIMEOUT)
+        except TimeoutError:
+            logger.warning("Process %s did not exit after SIGTERM, killing it", self.process.pid)
+            self.process.kill()
+            await self.process.wait()
 
 
 class FileFetchConnection(FileConnection, FetchConnection["FileTransport"]):
@@ -53,19 +107,19 @@ class FilePushConnection(FileConnection, PushConnection["FileTransport"]):
         return await self._open_service_connection("git-receive-pack")
 
 
-class FileTransport(Transport):
+class FileTransport(Transport, url_prefix="file://"):
+    __slots__ = ("path",)
+
     def __init__(self, path: str | Path):
         if isinstance(path, str):
-            assert path.startswith("file://")
+            if not path.startswith("file://"):
+                raise ValueError(f"Invalid file URL: {path}")
             path = Path(path[7:])
 
-        self.path = path.resolve()
-        if not self.path.is_dir():
-            raise FileNotFoundError(f"Path {self.path} must point to a git repository")
-
-        objects = self.path / "objects"
-        if not objects.is_dir():
-            raise FileNotFoundError(f"Dir {self.path} doesn't look like a git repository")
+        # git services resolve the path themselves, so only canonicalize it for the error message
+        self.path = path
+        if not (path / "objects").is_dir():
+            raise FileNotFoundError(f"Path {path.resolve()} must point to a git repository")
 
     @classmethod
     def can_handle_url(cls, url: str) -> bool:
@@ -1,6 +1,11 @@
 import asyncio
+import functools
+import getpass
 import logging
-from typing import Literal
+import os
+import re
+import weakref
+from typing import Literal, Self
 
 import asyncssh
 
@@ -16,26 +21,184 @@ from .base import (
 
 logger = logging.getLogger(__name__)
 
+# OpenSSH servers allow 10 sessions per connection by default (MaxSessions)
+MAX_SESSIONS_PER_CONNECTION = 8
+# Number of unused connections kept open for later reuse
+MAX_IDLE_CONNECTIONS = 4
+KEEPALIVE_INTERVAL = 30
+# AES-GCM is hardware accelerated on most CPUs, so prefer it over asyncssh's default of chacha20-poly1305
+ENCRYPTION_ALGS = (
+    "aes128-gcm@openssh.com",
+    "aes256-gcm@openssh.com",
+    "chacha20-poly1305@openssh.com",
+    "aes256-ctr",
+    "aes192-ctr",
+    "aes128-ctr",
+)
+# Write buffer limits of the SSH channel, so packfile writes don't block on every chunk
+WRITE_BUFFER_HIGH = 1 << 20
+WRITE_BUFFER_LOW = 1 << 18
+
+SSH_URL_RE = re.compile(
+    r"^ssh://(?:(?P<user>[^@/]+)@)?(?P<host>\[[^\]]+\]|[^:/]+)(?::(?P<port>\d+))?/(?P<path>.*)$",
+)
+
+
+type _PoolKey = tuple[str, int, str]
+
+
+class _PooledConnection:
+    __slots__ = ("key", "connection", "sessions")
+
+    def __init__(self, key: _PoolKey, connection: asyncssh.SSHClientConnection):
+        self.key = key
+        self.connection = connection
+        self.sessions = 0
+
+
+class SSHConnectionPool:
+    """
+    Keeps SSH connections open, so that multiple git services can be run over a single connection.
+
+    Connections are keyed by (host, port, user). When all pooled connections for a key have
+    ``max_sessions`` active sessions, a new connection is opened. Connections without active
+    sessions are kept open for reuse (up to ``max_idle``, least recently used are closed first).
+    """
+
+    def __init__(self, *, max_sessions: int = MAX_SESSIONS_PER_CONNECTION, max_idle: int = MAX_IDLE_CONNECTIONS):
+        self.max_sessions = max_sessions
+        self.max_idle = max_idle
+        self._entries: dict[_PoolKey, list[_PooledConnection]] = {}
+        self._locks: dict[_PoolKey, asyncio.Lock] = {}
+        self._in_use: dict[asyncssh.SSHClientConnection, _PooledConnection] = {}
+        # insertion ordered, so the first entry is the least recently used one
+        self._idle: dict[asyncssh.SSHClientConnection, _PooledConnection] = {}
+
+    async def acquire(self, transport: "SSHTransport") -> asyncssh.SSHClientConnection:
+        key = (transport.host, transport.port, transport.user)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+
+        async with lock:
+            entries = self._entries.setdefault(key, [])
+            for entry in list(entries):
+                if entry.connection.is_closed():
+                    self._discard(entry)
+                elif entry.sessions < self.max_sessions:
+                    break
+            else:
+                logger.debug("Opening SSH connection to %s:%d", transport.host, transport.port)
+                entry = _PooledConnection(key, await self._connect(transport))
+                entries.append(entry)
+
+            self._idle.pop(entry.connection, None)
+            self._in_use[entry.connection] = entry
+            entry.sessions += 1
+            return entry.connection
+
+    def release(self, connection: asyncssh.SSHClientConnection) -> None:
+        entry = self._in_use.get(connection)
+        if entry is None:
+            # not managed by the pool (anymore)
+            connection.close()
+            return
+
+        entry.sessions -= 1
+        if entry.sessions > 0:
+            return
+
+        del self._in_use[connection]
+        if connection.is_closed():
+            self._discard(entry)
+            return
+
+        self._idle[connection] = entry
+        while len(self._idle) > self.max_idle:
+            stale = next(iter(self._idle.values()))
+            self._discard(stale)
+            stale.connection.close()
+
+    def _discard(self, entry: _PooledConnection) -> None:
+        self._entries[entry.key].remove(entry)
+        self._idle.pop(entry.connection, None)
+        self._in_use.pop(entry.connection, None)
+
+    async def close(self) -> None:
+        connections = [entry.connection for entries in self._entries.values() for entry in entries]
+        self._entries.clear()
+        self._locks.clear()
+        self._in_use.clear()
+        self._idle.clear()
+
+        for connection in connections:
+            connection.close()
+        for connection in connections:
+            await connection.wait_closed()
+
+    async def _connect(self, transport: "SSHTransport") -> asyncssh.SSHClientConnection:
+        return await asyncssh.connect(
+            host=transport.host,
+            username=transport.user,
+            port=transport.port,
+            options=_client_options(),
+        )
+
+
+@functools.cache
+def _client_options() -> asyncssh.SSHClientConnectionOptions:
+    """
+    Options shared by all SSH connections, so known_hosts is parsed only once.
+    """
+    extra_options = {}
+    known_hosts_path = os.path.expanduser("~/.ssh/known_hosts")
+    if os.path.exists(known_hosts_path):
+        extra_options["known_hosts"] = asyncssh.read_known_hosts(known_hosts_path)
+
+    return asyncssh.SSHClientConnectionOptions(
+        keepalive_interval=KEEPALIVE_INTERVAL,
+        encryption_algs=ENCRYPTION_ALGS,
+        # ignore_encrypted=False,
+        # passphrase=(lambda x: input("Enter passphrase for %s: " % x)), # type: ignore
+        **extra_options,
+    )
+
+
+# Connection pools of the event loops that opened SSH connections, see _pool()
+_pools: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, SSHConnectionPool] = weakref.WeakKeyDictionary()
+
+
+def _pool() -> SSHConnectionPool:
+    """
+    The connection pool of the running event loop. Connections and locks are bound to the loop that created them,
+    so they can't be shared between loops.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = SSHConnectionPool()
+    return pool
+
 
 class SSHConnection(BaseConnection["SSHTransport"]):
-    _ssh: asyncssh.SSHClientConnection
+    # The pooled connection the service runs on, None when no session is held
+    _ssh: asyncssh.SSHClientConnection | None = None
+
+    async def __aenter__(self) -> Self:
+        try:
+            return await super().__aenter__()  # type: ignore
+        except BaseException:
+            # __aexit__ isn't called when entering fails, so the session would never be released
+            if self._ssh is not None:
+                self._process.close()
+                self._release()
+            raise
 
     async def _open_service_connection(
         self, service_name: Literal["git-upload-pack", "git-receive-pack"]
     ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
         logger.debug("Connecting to %s", self.transport.path)
 
-        options = asyncssh.SSHClientConnectionOptions(
-            # ignore_encrypted=False,
-            # passphrase=(lambda x: input("Enter passphrase for %s: " % x)), # type: ignore
-        )
-        # open the SSH connection
-        self._ssh = await asyncssh.connect(
-            host=self.transport.host,
-            username=self.transport.user,
-            port=self.transport.port,
-            options=options,
-        )
+        # get an SSH connection, reusing an already open one if possible
+        self._ssh = await _pool().acquire(self.transport)
 
         try:
             # run the git-upload-pack command
@@ -44,10 +207,11 @@ class SSHConnection(BaseConnection["SSHTransport"]):
                 env={"GIT_PROTOCOL": self.git_protocol},
                 encoding=None,
             )
+            self._process.channel.set_write_buffer_limits(high=WRITE_BUFFER_HIGH, low=WRITE_BUFFER_LOW)
 
             return self._process.stdout, self._process.stdin  # type: ignore
         except Exception:
-            self._ssh.close()
+            self._release()
             raise
 
     async def _close_service_connection(self) -> None:
@@ -55,7 +219,12 @@ class SSHConnection(BaseConnection["SSHTransport"]):
             self._process.stdin.write_eof()
             await self._process.wait()
         finally:
-            self._ssh.close()
+            self._release()
+
+    def _release(self) -> None:
+        assert self._ssh is not None
+        _pool().release(self._ssh)
+        self._ssh = None
 
     async def _read_packet(self) -> PacketLine:
         try:
@@ -82,20 +251,19 @@ class SSHPushConnection(SSHConnection, PushConnection["SSHTransport"]):
         return await self._open_service_connection("git-receive-pack")
 
 
-class SSHTransport(Transport):
-    def __init__(self, url: str):
-        assert url.startswith("ssh://")
-        address, self.path = url[6:].split("/", 1)
-        self.user, host = address.split("@", 1)
+class SSHTransport(Transport, url_prefix="ssh://"):
+    __slots__ = ("user", "host", "port", "path")
 
-        print("HOST:", host)
+    def __init__(self, url: str):
+        m = SSH_URL_RE.match(url)
+        if m is None:
+            raise ValueError(f"Invalid SSH URL: {url}")
 
-        if ":" in host:
-            self.host, port = host.split(":", 1)
-            self.port = int(port)
-        else:
-            self.host = host
-            self.port = 22
+        self.user = m["user"] or getpass.getuser()
+        # IPv6 addresses are enclosed in brackets, so they can be told apart from the port
+        self.host = m["host"].removeprefix("[").removesuffix("]")
+        self.port = int(m["port"]) if m["port"] else 22
+        self.path = m["path"]
 
     @classmethod
     def can_handle_url(cls, url: str) -> bool:
@@ -107,6 +275,16 @@ class SSHTransport(Transport):
     def push(self) -> SSHPushConnection:
         return SSHPushConnection(transport=self)
 
+    @classmethod
+    async def close_pool(cls) -> None:
+        """
+        Close all SSH connections kept open for reuse.
+        """
+        pool = _pools.pop(asyncio.get_running_loop(), None)
+        if pool is not None:
+            await pool.close()
+
     @property
     def url(self) -> str:
-        return f"ssh://{self.user}@{self.host}:{self.port}/{self.path}"
+        host = f"[{self.host}]" if ":" in self.host else self.host
+        return f"ssh://{self.user}@{host}:{self.port}/{self.path}"
@@ -1,6 +1,9 @@
+import importlib.util
+
 import pytest
 
-from kalandra.gitprotocol import PacketLine, PacketLineType
+from kalandra import gitprotocol
+from kalandra.gitprotocol import PacketLine, PacketLineType, Ref
 
 
 @pytest.mark.parametrize(
@@ -49,3 +52,68 @@ def test_packetline_too_short():
 def test_packetline_create_with_length_exceeding_buffer():
     with pytest.raises(ValueError):
         PacketLine.from_buffer(b"0006X")
+
+
+def test_packetline_sniff_buffer_with_offset():
+    data = b"0006a\n0000000bfoobar\n"
+
+    assert PacketLine.sniff_buffer(data, 0) == (PacketLineType.DATA, 2, 4)
+    assert PacketLine.sniff_buffer(data, 6) == (PacketLineType.FLUSH, 0, 10)
+    assert PacketLine.sniff_buffer(data, 10) == (PacketLineType.DATA, 7, 14)
+    assert PacketLine.sniff_buffer(data, 20) == (None, -3, 24)
+
+    line = PacketLine.from_buffer(data, 10)
+    assert line.data == b"foobar\n"
+
+
+def test_ref_from_line():
+    ref = Ref.from_line("0123456789abcdef0123456789abcdef01234567 refs/heads/main")
+    assert ref == Ref(name="refs/heads/main", object_id=bytes.fromhex("0123456789abcdef0123456789abcdef01234567"))
+    assert ref.name == "refs/heads/main"
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "0123456789abcdef0123456789abcdef01234567",
+        "0123456789abcdef0123456789abcdef01234567 ",
+        "0123456789abcdef0123456789abcdef01234567 refs/heads/main extra",
+        "not-hex refs/heads/main",
+    ],
+)
+def test_ref_from_line_invalid(line: str):
+    with pytest.raises(ValueError):
+        Ref.from_line(line)
+
+
+def test_ref_from_line_bytes():
+    ref = Ref.from_line_bytes(b"0123456789abcdef0123456789abcdef01234567 refs/heads/main\n")
+    assert ref == Ref(name="refs/heads/main", object_id=bytes.fromhex("0123456789abcdef0123456789abcdef01234567"))
+
+    with pytest.raises(ValueError):
+        Ref.from_line_bytes(b"0123456789abcdef0123456789abcdef01234567\n")
+    with pytest.raises(ValueError):
+        Ref.from_line_bytes(b"not-hex refs/heads/main\n")
+
+
+def test_ref_from_line_bytes_cached(monkeypatch: pytest.MonkeyPatch):
+    # the cache size is read on import, so load a separate copy of the module with it set
+    monkeypatch.setenv("KALANDRA_REF_CACHE_SIZE", "2")
+    spec = importlib.util.spec_from_file_location("kalandra_gitprotocol_cached", gitprotocol.__file__)
+    assert spec is not None and spec.loader is not None
+    cached = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cached)
+    CachedRef = cached.Ref
+
+    line = b"0123456789abcdef0123456789abcdef01234567 refs/heads/main\n"
+    ref = CachedRef.from_line_bytes(line)
+    assert ref == ("refs/heads/main", bytes.fromhex("0123456789abcdef0123456789abcdef01234567"))
+    assert type(ref) is CachedRef
+    assert CachedRef.from_line_bytes(line) is ref
+    assert CachedRef.from_line_bytes.cache_info().hits == 1
+
+    with pytest.raises(ValueError):
+        CachedRef.from_line_bytes(b"not-hex refs/heads/main\n")
+
+    # the module imported without the variable doesn't cache
+    assert not hasattr(Ref.from_line_bytes, "cache_info")
@@ -0,0 +1,102 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+from kalandra import __main__ as cli
+
+
+def test_read_repos_file(tmp_path: Path):
+    repos_file = tmp_path / "repos.txt"
+    repos_file.write_text(
+        "# upstream mirror\n"
+        "file:///up/a.git file:///mirror/a.git\n"
+        "\n"
+        "   \n"
+        "  ssh://git@example.com/b.git   file:///mirror/b.git  \n"
+    )
+
+    assert cli.read_repos_file(str(repos_file)) == [
+        ("file:///up/a.git", "file:///mirror/a.git"),
+        ("ssh://git@example.com/b.git", "file:///mirror/b.git"),
+    ]
+
+
+@pytest.mark.parametrize("line", ["file:///up/a.git", "file:///up/a.git file:///mirror/a.git extra"])
+def test_read_repos_file_malformed_line(tmp_path: Path, line: str):
+    repos_file = tmp_path / "repos.txt"
+    repos_file.write_text(f"# comment\n{line}\n")
+
+    with pytest.raises(ValueError, match=r"repos.txt:2: expected 'UPSTREAM MIRROR'"):
+        cli.read_repos_file(str(repos_file))
+
+
+@pytest.mark.parametrize(
+    "content, error",
+    [
+        (None, "No such file or directory"),
+        ("file:///up/a.git\n", "repos.txt:1: expected 'UPSTREAM MIRROR'"),
+    ],
+)
+def test_main_reports_invalid_repos_file(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path, content: str | None, error: str
+):
+    repos_file = tmp_path / "repos.txt"
+    if content is not None:
+        repos_file.write_text(content)
+
+    with pytest.raises(SystemExit) as exc_info:
+        _run_main(monkeypatch, ["--repos-file", str(repos_file)], failing=set(), updated=[])
+
+    assert exc_info.value.code == 2
+    stderr = capsys.readouterr().err
+    assert "error: --repos-file: " in stderr
+    assert error in stderr
+
+
+@pytest.mark.parametrize("jobs", ["0", "-1", "two"])
+def test_invalid_jobs(jobs: str):
+    with pytest.raises(SystemExit) as exc_info:
+        cli.create_parser().parse_args(["up", "mirror", "--jobs", jobs])
+
+    assert exc_info.value.code == 2
+
+
+def _run_main(monkeypatch: pytest.MonkeyPatch, argv: list[str], failing: set[str], updated: list[str]) -> None:
+    async def update_mirror(upstream: str, mirror: str, *, dry_run: bool) -> None:
+        if upstream in failing:
+            raise RuntimeError(f"Failed to fetch {upstream}")
+        updated.append(mirror)
+
+    async def close_pool() -> None:
+        pass
+
+    monkeypatch.setattr(sys, "argv", ["kalandra", *argv])
+    monkeypatch.setattr(cli, "update_mirror", update_mirror)
+    monkeypatch.setattr(cli.Transport, "from_url", staticmethod(lambda url: url))
+    monkeypatch.setattr(cli.Transport, "close_pool", close_pool)
+
+    asyncio.run(cli.main())
+
+
+def test_main_updates_all_pairs(monkeypatch: pytest.MonkeyPatch):
+    updated: list[str] = []
+    _run_main(monkeypatch, ["up1", "mirror1", "--pair", "up2", "mirror2"], failing=set(), updated=updated)
+
+    assert sorted(updated) == ["mirror1", "mirror2"]
+
+
+def test_main_exits_with_error_if_any_pair_failed(monkeypatch: pytest.MonkeyPatch):
+    updated: list[str] = []
+    with pytest.raises(SystemExit) as exc_info:
+        _run_main(monkeypatch, ["up1", "mirror1", "--pair", "up2", "mirror2"], failing={"up1"}, updated=updated)
+
+    assert exc_info.value.code == 1
+    # a failing pair doesn't stop the others from being updated
+    assert updated == ["mirror2"]
+
+
+def test_main_single_pair_raises(monkeypatch: pytest.MonkeyPatch):
+    with pytest.raises(RuntimeError, match="Failed to fetch up1"):
+        _run_main(monkeypatch, ["up1", "mirror1"], failing={"up1"}, updated=[])
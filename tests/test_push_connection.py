@@ -0,0 +1,81 @@
+import asyncio
+
+from kalandra.gitprotocol import NULL_OBJECT_ID, PacketLine, RefChange
+from kalandra.streams import PipeStream
+from kalandra.transports.base import PushConnection
+
+MAIN = bytes.fromhex("a" * 40)
+
+
+class ExitingServerWriter:
+    """
+    Writer to a receive-pack that exits once it got the update commands, like a real one does.
+    """
+
+    def __init__(self) -> None:
+        self.written = bytearray()
+        self.server_exited = False
+
+    def _check_open(self) -> None:
+        if self.server_exited:
+            raise BrokenPipeError("The server closed its input")
+
+    def write(self, data: bytes) -> None:
+        self._check_open()
+        self.written += data
+        # the commands are terminated by a flush packet, there's no packfile when all of them are deletes
+        self.server_exited = self.written.endswith(b"0000")
+
+    def writelines(self, data: list[bytes]) -> None:
+        self.write(b"".join(data))
+
+    def write_eof(self) -> None:
+        self._check_open()
+
+    async def drain(self) -> None:
+        pass
+
+    def is_closing(self) -> bool:
+        return self.server_exited
+
+    def close(self) -> None:
+        pass
+
+
+class FakePushConnection(PushConnection[None]):  # type: ignore
+    def __init__(self, server_output: bytes):
+        super().__init__(transport=None)  # type: ignore
+        self.server_output = server_output
+        self.server_input = ExitingServerWriter()
+
+    async def _open_push_service_connection(self):  # type: ignore
+        reader = asyncio.StreamReader()
+        reader.feed_data(self.server_output)
+        reader.feed_eof()
+        return reader, self.server_input
+
+    async def _close_service_connection(self) -> None:
+        pass
+
+
+def _pkt_lines(*lines: str) -> bytes:
+    packets = [PacketLine.data_from_string(line) for line in lines]
+    return b"".join(packet.marker_bytes + packet.data for packet in packets) + b"0000"
+
+
+def test_push_to_server_that_exited_after_the_request():
+    server_output = _pkt_lines(
+        "version 1",
+        f"{MAIN.hex()} refs/heads/main\0report-status delete-refs",
+    ) + _pkt_lines("unpack ok", "ok refs/heads/main")
+
+    async def run() -> bytes:
+        connection = FakePushConnection(server_output)
+        packfile = PipeStream()
+        await packfile.close()
+        async with connection:
+            await connection.send_change_request([RefChange("refs/heads/main", MAIN, NULL_OBJECT_ID)], packfile)
+        return bytes(connection.server_input.written)
+
+    # nothing is written once the server has the commands
+    assert asyncio.run(run()).endswith(b"refs/heads/main\0report-status\n0000")
@@ -0,0 +1,24 @@
+import asyncio
+
+from kalandra.streams import PipeStream
+
+
+def test_pipe_stream_passes_data_between_tasks():
+    async def run() -> bytes:
+        pipe = PipeStream(max_chunks=2)
+
+        async def produce() -> None:
+            for i in range(10):
+                await pipe.write(b"chunk%d;" % i)
+            await pipe.close()
+
+        async def consume() -> bytes:
+            received = bytearray()
+            while data := await pipe.read(4):
+                received += data
+            return bytes(received)
+
+        _, received = await asyncio.gather(produce(), consume())
+        return received
+
+    assert asyncio.run(run()) == b"".join(b"chunk%d;" % i for i in range(10))
@@ -0,0 +1,345 @@
+import asyncio
+
+import pytest
+
+from kalandra.gitprotocol import NULL_OBJECT_ID, PacketLine, PacketLineType
+from kalandra.transports import file, ssh
+from kalandra.transports.base import BaseConnection, ConnectionException, FetchConnection, Transport
+from kalandra.transports.ssh import SSHConnectionPool, SSHTransport
+
+
+@pytest.mark.parametrize(
+    "url, user, host, port, path",
+    [
+        ("ssh://git@example.com/repo.git", "git", "example.com", 22, "repo.git"),
+        ("ssh://git@example.com:2222/org/repo.git", "git", "example.com", 2222, "org/repo.git"),
+        ("ssh://git@[::1]:2222/repo.git", "git", "::1", 2222, "repo.git"),
+        ("ssh://git@[::1]/repo.git", "git", "::1", 22, "repo.git"),
+    ],
+)
+def test_ssh_transport_parse_url(url: str, user: str, host: str, port: int, path: str):  # type: ignore
+    transport = SSHTransport(url)
+
+    assert transport.user == user
+    assert transport.host == host
+    assert transport.port == port
+    assert transport.path == path
+
+
+def test_ssh_transport_default_user(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("getpass.getuser", lambda: "alice")
+
+    transport = SSHTransport("ssh://example.com/repo.git")
+
+    assert transport.user == "alice"
+    assert transport.url == "ssh://alice@example.com:22/repo.git"
+
+
+@pytest.mark.parametrize("url", ["ssh://example.com", "ssh://user@host:port/repo.git", "file:///repo.git"])
+def test_ssh_transport_invalid_url(url: str):
+    with pytest.raises(ValueError):
+        SSHTransport(url)
+
+
+def test_read_packets_split_across_reads():
+    async def run() -> list[tuple[PacketLineType, bytes]]:
+        reader = asyncio.StreamReader()
+        connection = BaseConnection(transport=None)  # type: ignore
+        connection.reader = reader
+
+        async def feed() -> None:
+            data = b"0006a\n0001000bfoobar\n0000"
+            # the server can split the packets at any point
+            for i in range(0, len(data), 3):
+                reader.feed_data(data[i : i + 3])
+                await asyncio.sleep(0)
+            reader.feed_eof()
+
+        feeder = asyncio.create_task(feed())
+        packets = [await connection._read_packet() for _ in range(4)]
+        await feeder
+        return [(packet.type, packet.data) for packet in packets]
+
+    assert asyncio.run(run()) == [
+        (PacketLineType.DATA, b"a\n"),
+        (PacketLineType.DELIMITER, b""),
+        (PacketLineType.DATA, b"foobar\n"),
+        (PacketLineType.FLUSH, b""),
+    ]
+
+
+def test_read_packet_eof_in_the_middle_of_packet():
+    async def run() -> None:
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"000bfoo")
+        reader.feed_eof()
+        connection = BaseConnection(transport=None)  # type: ignore
+        connection.reader = reader
+        await connection._read_packet()
+
+    with pytest.raises(asyncio.IncompleteReadError) as exc_info:
+        asyncio.run(run())
+    assert exc_info.value.partial == b"000bfoo"
+    assert exc_info.value.expected == 11
+
+
+def test_read_v1_server_hello_of_empty_repository():
+    async def run() -> tuple[dict[str, bytes], frozenset[str]]:
+        reader = asyncio.StreamReader()
+        for line in ("version 1", f"{NULL_OBJECT_ID.hex()} capabilities^{{}}\0report-status delete-refs"):
+            packet = PacketLine.data_from_string(line)
+            reader.feed_data(packet.marker_bytes + packet.data)
+        reader.feed_data(b"0000")
+        connection = BaseConnection(transport=None)  # type: ignore
+        connection.reader = reader
+        return await connection._read_v1_server_hello()
+
+    refs, capabilities = asyncio.run(run())
+    assert refs == {}
+    assert capabilities == {"report-status", "delete-refs"}
+
+
+def test_read_packets_until_flush_yields_only_data():
+    async def run(data: bytes) -> list[bytes]:
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        connection = BaseConnection(transport=None)  # type: ignore
+        connection.reader = reader
+        return [packet.data async for packet in connection._read_packets_until_flush()]
+
+    assert asyncio.run(run(b"0006a\n0006b\n0000")) == [b"a\n", b"b\n"]
+    with pytest.raises(ValueError):
+        asyncio.run(run(b"0006a\n00010000"))
+
+
+def test_transport_from_url():
+    transport = Transport.from_url("ssh://git@example.com/repo.git")
+    assert isinstance(transport, SSHTransport)
+
+    with pytest.raises(ValueError):
+        Transport.from_url("gopher://example.com/repo.git")
+
+
+def test_process_ack_section():
+    acked = bytes.fromhex("0123456789abcdef0123456789abcdef01234567")
+    other = bytes(range(20))
+
+    async def run(data: bytes) -> set[bytes]:
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        connection = FetchConnection(transport=None)  # type: ignore
+        connection.reader = reader
+        missing_objects = {acked, other}
+        await connection._process_ack_section(connection._read_packets_section(), missing_objects)
+        return missing_objects
+
+    section = b"".join(
+        packet.marker_bytes + packet.data
+        for packet in (
+            PacketLine.data_from_string(f"ACK {acked.hex()}"),
+            PacketLine.data_from_string("ready"),
+            PacketLine.DELIMITER,
+        )
+    )
+    assert asyncio.run(run(section)) == {other}
+
+    # a section ending with a flush means the server won't send a packfile
+    with pytest.raises(ConnectionException):
+        asyncio.run(run(b"0008NAK\n0000"))
+
+
+class FakeSSHConnection:
+    def __init__(self, name: str):
+        self.name = name
+        self.closed = False
+        self.wait_closed_called = False
+
+    def is_closed(self) -> bool:
+        return self.closed
+
+    def close(self) -> None:
+        self.closed = True
+
+    async def wait_closed(self) -> None:
+        self.wait_closed_called = True
+
+
+class FakeSSHConnectionPool(SSHConnectionPool):
+    def __init__(self, **kwargs):  # type: ignore
+        super().__init__(**kwargs)
+        self.opened: list[FakeSSHConnection] = []
+
+    async def _connect(self, transport: SSHTransport) -> FakeSSHConnection:  # type: ignore
+        # let other tasks run, as a real connection would
+        await asyncio.sleep(0)
+        connection = FakeSSHConnection(f"{transport.host}-{len(self.opened)}")
+        self.opened.append(connection)
+        return connection
+
+
+def test_ssh_pool_shares_connection_up_to_max_sessions():
+    async def run() -> None:
+        pool = FakeSSHConnectionPool(max_sessions=2)
+        transport = SSHTransport("ssh://git@example.com/repo.git")
+
+        first = await pool.acquire(transport)
+        second = await pool.acquire(transport)
+        third = await pool.acquire(transport)
+        other_host = await pool.acquire(SSHTransport("ssh://git@example.org/repo.git"))
+
+        assert first is second
+        assert third is not first
+        assert other_host not in (first, third)
+        assert len(pool.opened) == 3
+
+        # a released session makes room on the first connection again
+        pool.release(first)
+        assert await pool.acquire(transport) is first
+
+    asyncio.run(run())
+
+
+def test_ssh_pool_opens_one_connection_for_concurrent_acquires():
+    async def run() -> None:
+        pool = FakeSSHConnectionPool(max_sessions=8)
+        transport = SSHTransport("ssh://git@example.com/repo.git")
+
+        connections = await asyncio.gather(*(pool.acquire(transport) for _ in range(5)))
+
+        assert len(pool.opened) == 1
+        assert all(connection is pool.opened[0] for connection in connections)
+
+    asyncio.run(run())
+
+
+def test_ssh_pool_discards_closed_connections():
+    async def run() -> None:
+        pool = FakeSSHConnectionPool()
+        transport = SSHTransport("ssh://git@example.com/repo.git")
+
+        first = await pool.acquire(transport)
+        pool.release(first)
+        first.close()
+
+        second = await pool.acquire(transport)
+        assert second is not first
+        assert len(pool.opened) == 2
+
+        # closed while in use, it's dropped when released
+        second.close()
+        pool.release(second)
+        assert not pool._idle
+        assert await pool.acquire(transport) is pool.opened[2]
+
+    asyncio.run(run())
+
+
+def test_ssh_pool_closes_least_recently_used_idle_connections():
+    async def run() -> None:
+        pool = FakeSSHConnectionPool(max_idle=2)
+        connections = [await pool.acquire(SSHTransport(f"ssh://git@host{i}/repo.git")) for i in range(3)]
+
+        for connection in connections:
+            pool.release(connection)
+
+        assert [connection.closed for connection in connections] == [True, False, False]
+        # the idle connections are reused
+        assert await pool.acquire(SSHTransport("ssh://git@host2/repo.git")) is connections[2]
+        assert len(pool.opened) == 3
+
+    asyncio.run(run())
+
+
+def test_ssh_pool_close():
+    async def run() -> None:
+        pool = FakeSSHConnectionPool()
+        transport = SSHTransport("ssh://git@example.com/repo.git")
+        idle = await pool.acquire(transport)
+        pool.release(idle)
+        in_use = await pool.acquire(SSHTransport("ssh://git@example.org/repo.git"))
+
+        await pool.close()
+
+        for connection in (idle, in_use):
+            assert connection.closed
+            assert connection.wait_closed_called
+
+        # releasing a connection the pool no longer manages closes it
+        in_use.closed = False
+        pool.release(in_use)
+        assert in_use.closed
+
+    asyncio.run(run())
+
+
+class FakeSSHProcess:
+    def __init__(self, stdout: bytes):
+        self.stdout = asyncio.StreamReader()
+        self.stdout.feed_data(stdout)
+        self.stdout.feed_eof()
+        self.stdin = None
+        self.exit_status = None
+        self.closed = False
+
+    @property
+    def channel(self):  # type: ignore
+        return self
+
+    def set_write_buffer_limits(self, high: int, low: int) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_ssh_connection_releases_session_when_enter_fails():
+    processes: list[FakeSSHProcess] = []
+
+    class ProcessConnection(FakeSSHConnection):
+        async def create_process(self, *args, **kwargs) -> FakeSSHProcess:  # type: ignore
+            # a v1 server, while the fetch connection expects protocol v2
+            processes.append(FakeSSHProcess(b"000eversion 1\n"))
+            return processes[-1]
+
+    class ProcessConnectionPool(FakeSSHConnectionPool):
+        async def _connect(self, transport: SSHTransport) -> FakeSSHConnection:  # type: ignore
+            return ProcessConnection(transport.host)
+
+    pool = ProcessConnectionPool()
+
+    async def run() -> None:
+        ssh._pools[asyncio.get_running_loop()] = pool
+        async with SSHTransport("ssh://git@example.com/repo.git").fetch():
+            pass
+
+    with pytest.raises(ValueError, match="Unexpected version packet"):
+        asyncio.run(run())
+
+    assert [process.closed for process in processes] == [True]
+    assert not pool._in_use
+    assert len(pool._idle) == 1
+
+
+def test_ssh_pool_per_event_loop():
+    async def run() -> tuple[SSHConnectionPool, SSHConnectionPool]:
+        pool = ssh._pool()
+        same = ssh._pool()
+        await SSHTransport.close_pool()
+        return pool, same
+
+    first, same = asyncio.run(run())
+    second, _ = asyncio.run(run())
+
+    assert first is same
+    # each loop gets its own pool, as its connections and locks can only be used from that loop
+    assert first is not second
+
+
+def test_file_spawn_semaphore_per_event_loop():
+    async def run() -> asyncio.Semaphore:
+        semaphore = file._spawn_semaphore()
+        assert file._spawn_semaphore() is semaphore
+        return semaphore
+
+    assert asyncio.run(run()) is not asyncio.run(run())
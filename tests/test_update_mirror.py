@@ -0,0 +1,136 @@
+import asyncio
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+import pytest
+
+from kalandra.commands.update_mirror import calculate_mirror_updates, update_mirror
+from kalandra.gitprotocol import NULL_OBJECT_ID, Ref, RefChange
+from kalandra.streams import PipeStream
+from kalandra.transports import Transport
+
+A = bytes.fromhex("a" * 40)
+B = bytes.fromhex("b" * 40)
+C = bytes.fromhex("c" * 40)
+
+
+async def _iter_refs(refs: list[Ref]) -> AsyncIterator[Ref]:
+    for ref in refs:
+        yield ref
+
+
+def _calculate(mirror_refs: dict[str, bytes], upstream_refs: list[Ref]) -> set[RefChange]:
+    async def collect() -> set[RefChange]:
+        return {change async for change in calculate_mirror_updates(mirror_refs, _iter_refs(upstream_refs))}
+
+    return asyncio.run(collect())
+
+
+def test_calculate_mirror_updates():
+    mirror_refs = {
+        "HEAD": A,
+        "refs/heads/main": A,
+        "refs/heads/stale": B,
+        "refs/tags/v1": C,
+        "refs/remotes/origin/main": A,
+    }
+    upstream_refs = [
+        Ref("HEAD", B),
+        Ref("refs/heads/main", B),
+        Ref("refs/heads/new", C),
+        Ref("refs/tags/v1", C),
+        Ref("refs/remotes/origin/main", A),
+    ]
+
+    assert _calculate(mirror_refs, upstream_refs) == {
+        RefChange("refs/heads/main", A, B),
+        RefChange("refs/heads/new", NULL_OBJECT_ID, C),
+        RefChange("refs/heads/stale", B, NULL_OBJECT_ID),
+        RefChange("refs/remotes/origin/main", A, NULL_OBJECT_ID),
+    }
+
+
+def test_calculate_mirror_updates_up_to_date():
+    refs = {"refs/heads/main": A, "refs/tags/v1": B}
+
+    assert _calculate(refs, [Ref(name, object_id) for name, object_id in refs.items()]) == set()
+
+
+class FailingFetchConnection:
+    async def __aenter__(self) -> "FailingFetchConnection":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:  # type: ignore
+        pass
+
+    async def ls_refs(self) -> AsyncIterator[Ref]:
+        yield Ref("refs/heads/main", A)
+
+    async def send_fetch_request(self, objects: set[bytes], *, have: set[bytes], output: PipeStream) -> None:
+        raise ConnectionError("upstream went away")
+
+
+class WaitingPushConnection:
+    refs: dict[str, bytes] = {}
+
+    async def __aenter__(self) -> "WaitingPushConnection":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:  # type: ignore
+        pass
+
+    async def send_change_request(self, changes: list[RefChange], packfile: PipeStream) -> None:
+        while await packfile.read():
+            pass
+
+
+def test_update_mirror_raises_error_of_failed_side():
+    upstream = SimpleNamespace(fetch=FailingFetchConnection)
+    mirror = SimpleNamespace(push=WaitingPushConnection)
+
+    # the push is cancelled when the fetch fails, the fetch error is raised as is instead of in an ExceptionGroup
+    with pytest.raises(ConnectionError, match="upstream went away"):
+        asyncio.run(update_mirror(upstream, mirror))  # type: ignore
+
+
+# Identity for the commits created by the tests
+GIT_ENV = {
+    "PATH": os.environ.get("PATH", ""),
+    "GIT_AUTHOR_NAME": "Test",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "Test",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+}
+
+
+def _git(*args: str | Path, input: str | None = None) -> str:
+    return subprocess.run(["git", *args], input=input, env=GIT_ENV, check=True, capture_output=True, text=True).stdout
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_update_mirror_deletes_only(tmp_path: Path):
+    upstream = tmp_path / "upstream.git"
+    mirror = tmp_path / "mirror.git"
+
+    _git("init", "-q", "--bare", upstream)
+    empty_tree = _git("-C", upstream, "hash-object", "-t", "tree", "-w", "--stdin", input="").strip()
+    commit = _git("-C", upstream, "commit-tree", empty_tree, "-m", "init").strip()
+    # Enough deletes that the server is still applying them if it's stopped right after the commands are sent
+    stale = [f"refs/heads/stale-{i}" for i in range(20)]
+    _git(
+        "-C",
+        upstream,
+        "update-ref",
+        "--stdin",
+        input="".join(f"create {ref} {commit}\n" for ref in [*stale, "refs/heads/main"]),
+    )
+    _git("clone", "-q", "--mirror", upstream, mirror)
+    _git("-C", upstream, "update-ref", "--stdin", input="".join(f"delete {ref}\n" for ref in stale))
+
+    asyncio.run(update_mirror(Transport.from_url(f"file://{upstream}"), Transport.from_url(f"file://{mirror}")))
+
+    assert _git("-C", mirror, "show-ref") == _git("-C", upstream, "show-ref")